@@ -7,25 +7,53 @@ Synology DS920+ Advanced Fan Controller
   * Full mode (≥55°C)
 - Uses multiple temperature sources for reliability
 - Includes proper state management and error handling
+- Runs once per invocation (Task Scheduler) or as a long-lived loop with --daemon
 """
 
+import functools
 import json
 import os
+import signal
+import socket
+import ssl
+import sys
+import threading
 import time
-import pathlib
+import certifi
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPSConnection
+from urllib3.connectionpool import HTTPSConnectionPool
+from urllib3.util.connection import create_connection
+from urllib3.util.retry import Retry
+from urllib3.util.ssl_match_hostname import CertificateError
 from typing import Optional, Tuple
+from urllib.parse import urlsplit
+
+# Prefer orjson for faster JSON handling, fall back to the stdlib when it isn't installed
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
 
 # ----------------- CONFIGURATION -----------------
 DSM_HOST = "https://domain.synology.me:5001"            # DSM host address, use a synology DDNS & Cert
 DSM_USER = "dedicatedscriptusername"                     # DSM username
 DSM_PASS = "randompass"              # DSM password
-VERIFY_SSL = True                       # Verify SSL certificate, if https:// workwing with the Doamain. 
+VERIFY_SSL = True                       # Verify SSL certificate, if https:// workwing with the Doamain. Or a CA bundle path for a self-signed cert
 SESSION_NAME = "fancontrol"             # Session name for API
 
 # Temperature thresholds (in Celsius)
 TEMP_QUIET_MAX = 40                     # Below this: quiet mode, above: cool mode
 TEMP_COOL_MAX = 55                      # Below this: cool mode, above: full mode
+TEMP_HYSTERESIS = 2                     # Degrees past a threshold needed before switching modes
+TEMP_EWMA_ALPHA = 0.3                   # Weight of the newest reading in the smoothed temperature
+TEMP_STEADY_DELTA = 1.0                 # Readings closer than this to the smoothed value count as unchanged
 
 # Fan modes (verify these match your DSM's available modes)
 QUIET_MODE = "quietfan"
@@ -34,168 +62,332 @@ FULL_MODE = "fullfan"
 
 # State management
 STATE_FILE = "/volume1/scripts/.fanstate.json"  # Chnage to the folder where scripts are hosted. 
-FORCE_REFRESH_INTERVAL = 300            # Re-apply mode every 5 minutes (seconds)
+STATE_FILE_MODE = 0o600                 # The state holds the DSM session, keep it private to the owner
+STATE_FSYNC = False                     # fsync the state file on save (state is advisory, off by default)
+FORCE_REFRESH_INTERVAL = 3600           # Last-resort re-apply of the mode every hour (seconds)
 MIN_MODE_CHANGE_INTERVAL = 60           # Minimum seconds between mode changes
+RUN_INTERVAL = 60                       # Seconds between checks when running with --daemon
+SESSION_MAX_AGE = 12 * 3600             # Reuse a cached DSM session for up to 12 hours (seconds)
+DNS_CACHE_TTL = 3600                    # Re-resolve the DSM host address every hour (seconds)
 
 # API endpoints
 API_AUTH = "/webapi/auth.cgi"
 API_ENTRY = "/webapi/entry.cgi"
+AUTH_ERROR_CODES = (105, 106, 107, 119) # DSM error codes for an expired/invalid session
 # ------------------------------------------------
 
+# Precomputed lookup tables (derived from the configuration above)
+FAN_MODES = (QUIET_MODE, COOL_MODE, FULL_MODE)     # Ordered from coolest to hottest
+TEMP_THRESHOLDS = (TEMP_QUIET_MAX, TEMP_COOL_MAX)  # Boundary between FAN_MODES[i] and FAN_MODES[i + 1]
+SYSFS_TEMP_MIN_MC = 10_000                          # Sane sysfs range, in millidegrees Celsius
+SYSFS_TEMP_MAX_MC = 110_000
+DSM_HOSTNAME = urlsplit(DSM_HOST).hostname
+DSM_PORT = urlsplit(DSM_HOST).port or 443
+
+# Hostname -> IP address used for new HTTPS connections instead of a DNS lookup
+DNS_PINS = {}
+
+def resolve_ca_bundle() -> str:
+    """
+    Return the CA bundle requests verifies DSM against: a VERIFY_SSL path,
+    else REQUESTS_CA_BUNDLE / CURL_CA_BUNDLE (which requests merges into verify), else certifi
+    """
+    if isinstance(VERIFY_SSL, str):
+        return VERIFY_SSL
+    return os.environ.get("REQUESTS_CA_BUNDLE") or os.environ.get("CURL_CA_BUNDLE") or certifi.where()
+
+@functools.lru_cache(maxsize=None)
+def build_ssl_context(ca_bundle: str) -> ssl.SSLContext:
+    """Build (once per process and CA bundle) the TLS context shared by every DSM connection"""
+    if os.path.isdir(ca_bundle):
+        ctx = ssl.create_default_context(capath=ca_bundle)
+    else:
+        ctx = ssl.create_default_context(cafile=ca_bundle)
+    if not VERIFY_SSL:
+        ctx.check_hostname = False
+        ctx.verify_mode = ssl.CERT_NONE
+    return ctx
+
+class PinnedHTTPSConnection(HTTPSConnection):
+    """HTTPSConnection that dials the pinned IP from DNS_PINS, if any
+
+    Only the TCP connect uses the IP; SNI and certificate checks still use the hostname.
+    If the pinned address doesn't answer, the pin is dropped and normal resolution is used.
+    If it answers but the TLS handshake or certificate check fails (e.g. the DDNS name
+    moved and the old IP now serves another host), the pin is dropped too so the retry
+    and the next runs resolve the name again.
+    """
+    def connect(self) -> None:
+        ip = DNS_PINS.get(self.host)
+        try:
+            super().connect()
+        except (ssl.SSLError, CertificateError) as e:
+            if ip and DNS_PINS.get(self.host) == ip:
+                print(f"[WARNING] TLS to pinned address {ip} for {self.host} failed: {str(e)}")
+                DNS_PINS.pop(self.host, None)
+            raise
+
+    def _new_conn(self) -> socket.socket:
+        ip = DNS_PINS.get(self.host)
+        if ip:
+            try:
+                return create_connection(
+                    (ip, self.port),
+                    self.timeout,
+                    source_address=self.source_address,
+                    socket_options=self.socket_options
+                )
+            except OSError as e:
+                print(f"[WARNING] Pinned address {ip} for {self.host} failed: {str(e)}")
+                DNS_PINS.pop(self.host, None)
+        return super()._new_conn()
+
+class PinnedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = PinnedHTTPSConnection
+
+class DSMAdapter(HTTPAdapter):
+    """HTTPAdapter whose pools share a pre-built SSLContext and honour DNS_PINS"""
+    def __init__(self, ca_bundle: str, **kwargs):
+        self.ca_bundle = ca_bundle
+        self.ssl_context = build_ssl_context(ca_bundle)
+        super().__init__(**kwargs)
+
+    def cert_verify(self, conn, url, verify, cert):
+        """
+        Only set the verification mode on the pool when the shared SSLContext
+        was built from the CA bundle requests asks for; the default implementation
+        would point ca_certs at it again and urllib3 would reload it for every connection
+        Any other bundle is left to the default implementation
+        """
+        if isinstance(verify, str) and verify != self.ca_bundle:
+            return super().cert_verify(conn, url, verify, cert)
+        if url.lower().startswith("https") and verify:
+            conn.cert_reqs = "CERT_REQUIRED"
+        else:
+            conn.cert_reqs = "CERT_NONE"
+        conn.ca_certs = None
+        conn.ca_cert_dir = None
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["ssl_context"] = self.ssl_context
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            **self.poolmanager.pool_classes_by_scheme,
+            "https": PinnedHTTPSConnectionPool,
+        }
+
 class FanController:
     def __init__(self):
         self.session = requests.Session()
+        # Keep one pooled connection alive so all DSM calls share a single TLS handshake
+        adapter = DSMAdapter(
+            resolve_ca_bundle(),
+            pool_connections=1,
+            pool_maxsize=4,
+            max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Connection": "keep-alive", "Accept-Encoding": "gzip, deflate"})
+        # Pre-bind the per-request options and URLs shared by every DSM call
+        # (DSM API replies never need a redirect, so don't follow any)
+        self._get = functools.partial(
+            self.session.get, verify=VERIFY_SSL, timeout=10, allow_redirects=False
+        )
+        self._auth_url = DSM_HOST + API_AUTH
+        self._entry_url = DSM_HOST + API_ENTRY
         self.sid = None
         self.token = None
+        self.dsm_mode = None                # Fan mode as currently reported by DSM
+        self._state_bytes = None            # Serialized state as last read/written
         self.state = {
             "last_mode": None,
-            "last_change": 0,
+            "last_change": 0,               # time.monotonic() of the last mode change, 0 = never
+            "boot_id": None,                # Boot the last_change timestamp belongs to
             "last_temp": None,
-            "temp_source": None
+            "temp_source": None,
+            "sid": None,
+            "token": None,
+            "sid_ts": 0,
+            "hwmon_path": None,
+            "ewma_temp": None,
+            "dns_ip": None,
+            "dns_ts": 0,
+            "failed_apis": []
         }
         
+    def _api_call(self, api: str, method: str, version: str = "1", auth: bool = False, **extra) -> dict:
+        """
+        Issue a DSM web API request and return the decoded JSON response
+        Calls to entry.cgi carry the session ID and SynoToken, auth.cgi calls don't
+        """
+        params = {"api": api, "version": version, "method": method, **extra}
+        if auth:
+            url = self._auth_url
+        else:
+            url = self._entry_url
+            params["_sid"] = self.sid
+            if self.token:
+                params["SynoToken"] = self.token
+        r = self._get(url, params=params)
+        r.raise_for_status()
+        return _json_loads(r.content)
+
     def login(self) -> str:
-        """Authenticate with DSM and return session ID"""
-        params = {
-            "api": "SYNO.API.Auth",
-            "version": "7.22",
-            "method": "login",
-            "account": DSM_USER,
-            "passwd": DSM_PASS,
-            "session": SESSION_NAME,
-            "format": "sid",
-        }
+        """Authenticate with DSM and return session ID (the SynoToken comes back with it)"""
         try:
-            r = self.session.get(
-                DSM_HOST + API_AUTH,
-                params=params,
-                verify=VERIFY_SSL,
-                timeout=10
+            data = self._api_call(
+                "SYNO.API.Auth", "login", version="7.22", auth=True,
+                account=DSM_USER, passwd=DSM_PASS, session=SESSION_NAME, format="sid",
+                enable_syno_token="yes"
             )
-            r.raise_for_status()
-            data = r.json()
             if not data.get("success"):
                 raise RuntimeError(f"DSM login failed: {data}")
             self.sid = data["data"]["sid"]
+            self.token = data["data"].get("synotoken") or data["data"].get("SynoToken")
+            self.state["sid"] = self.sid
+            self.state["token"] = self.token
+            self.state["sid_ts"] = time.time()
             return self.sid
         except Exception as e:
             raise RuntimeError(f"Login error: {str(e)}")
 
-    def get_temperature(self) -> Tuple[Optional[float], str]:
+    @staticmethod
+    def is_auth_error(result: dict) -> bool:
+        """Check whether a DSM response was rejected because of the session"""
+        return (
+            not result.get("success")
+            and result.get("error", {}).get("code") in AUTH_ERROR_CODES
+        )
+
+    def get_temperature(self, retry_auth: bool = True) -> Tuple[Optional[float], str]:
         """
         Get current temperature from multiple possible sources
         Returns (temperature, source) or (None, error_message)
+        The Thermal reading and the fan settings (and SynoToken) are fetched
+        in a single compound request; SYNO.Core.System is only asked when that fails
+        If the cached session has expired, logs in again and retries once
         """
-        # Try SYNO.Core.Hardware.Thermal first (most reliable)
-        params = {
-            "api": "SYNO.Core.Hardware.Thermal",
-            "version": "1",
-            "method": "status",
-            "_sid": self.sid
-        }
+        auth_expired = False
+        # Forget the previous run's report (daemon mode) until DSM answers again
+        self.dsm_mode = None
+        # Query SYNO.Core.Hardware.Thermal (most reliable) and SYNO.Core.Hardware.FanSpeed
+        # together in a single round-trip
+        compound = [
+            {"api": "SYNO.Core.Hardware.Thermal", "method": "status", "version": 1},
+            {"api": "SYNO.Core.Hardware.FanSpeed", "method": "get", "version": 1},
+        ]
         try:
-            r = self.session.get(
-                DSM_HOST + API_ENTRY,
-                params=params,
-                verify=VERIFY_SSL,
-                timeout=10
+            j = self._api_call(
+                "SYNO.Entry.Request", "request",
+                stop_when_error="false", compound=json.dumps(compound)
             )
-            r.raise_for_status()
-            j = r.json()
             if j.get("success"):
-                temp = j["data"].get("cpu_temp") or j["data"].get("system_temp")
-                if temp is not None:
-                    return float(temp), "SYNO.Core.Hardware.Thermal"
+                data = j.get("data", {})
+                results = data.get("result", [])
+                # Only name the failed calls (the full result carries the SynoToken),
+                # and only when that changes, so a model lacking an API doesn't log every run
+                failed = [
+                    f"{call['api']} (code {result.get('error', {}).get('code')})"
+                    for call, result in zip(compound, results)
+                    if not result.get("success")
+                ] if data.get("has_fail") else []
+                if failed != self.state["failed_apis"]:
+                    if failed:
+                        print(f"[DEBUG] Compound request partially failed: {', '.join(failed)}")
+                    self.state["failed_apis"] = failed
+                thermal = results[0] if len(results) > 0 else {}
+                fan = results[1] if len(results) > 1 else {}
+
+                if fan.get("success"):
+                    self.token = fan.get("data", {}).get("SynoToken") or self.token
+                    self.state["token"] = self.token
+                    self.dsm_mode = fan.get("data", {}).get("dual_fan_speed")
+
+                if thermal.get("success"):
+                    temp = thermal["data"].get("cpu_temp") or thermal["data"].get("system_temp")
+                    if temp is not None:
+                        return float(temp), "SYNO.Core.Hardware.Thermal"
+                elif retry_auth and self.is_auth_error(thermal):
+                    auth_expired = True
+            elif retry_auth and self.is_auth_error(j):
+                auth_expired = True
         except Exception:
             pass
 
-        # Fallback to SYNO.Core.System
-        params = {
-            "api": "SYNO.Core.System",
-            "version": "1",
-            "method": "info",
-            "_sid": self.sid
-        }
+        # Cached session rejected: re-authenticate and retry once
+        if auth_expired:
+            print("[DEBUG] DSM session expired, logging in again")
+            try:
+                self.login()
+                return self.get_temperature(retry_auth=False)
+            except RuntimeError as e:
+                print(f"[WARNING] {str(e)}")
+
+        # Fallback to SYNO.Core.System (only asked when Thermal gave no reading)
         try:
-            r = self.session.get(
-                DSM_HOST + API_ENTRY,
-                params=params,
-                verify=VERIFY_SSL,
-                timeout=10
-            )
-            r.raise_for_status()
-            j = r.json()
+            j = self._api_call("SYNO.Core.System", "info")
             if j.get("success") and "temp" in j.get("data", {}):
                 return float(j["data"]["temp"]), "SYNO.Core.System"
         except Exception:
             pass
 
-        # Final fallback to sysfs (direct hardware reading)
+        # Final fallback to sysfs (direct hardware reading),
+        # starting with the sensor that worked last time
+        cached_path = self.state["hwmon_path"]
+        if cached_path:
+            temp = self.read_sysfs_temp(cached_path)
+            if temp is not None:
+                return temp, f"sysfs:{cached_path}"
         try:
-            for p in pathlib.Path("/sys/class/hwmon").glob("hwmon*/temp*_input"):
-                with open(p) as fh:
-                    temp = int(fh.read().strip()) / 1000
-                if 10 < temp < 110:  # Basic sanity check
-                    return temp, f"sysfs:{p}"
+            with os.scandir("/sys/class/hwmon") as hwmons:
+                for hwmon in hwmons:
+                    if not hwmon.name.startswith("hwmon"):
+                        continue
+                    with os.scandir(hwmon.path) as sensors:
+                        for sensor in sensors:
+                            if not (sensor.name.startswith("temp") and sensor.name.endswith("_input")):
+                                continue
+                            temp = self.read_sysfs_temp(sensor.path)
+                            if temp is not None:
+                                self.state["hwmon_path"] = sensor.path
+                                return temp, f"sysfs:{sensor.path}"
         except Exception:
             pass
 
         return None, "No temperature source available"
 
-    def get_fan_token(self) -> Optional[str]:
-        """Get SynoToken if available (not strictly necessary)"""
-        params = {
-            "api": "SYNO.Core.Hardware.FanSpeed",
-            "version": "1",
-            "method": "get",
-            "_sid": self.sid
-        }
+    @staticmethod
+    def read_sysfs_temp(path: str) -> Optional[float]:
+        """Read a hwmon temp*_input file, returns None if unreadable or out of range"""
         try:
-            r = self.session.get(
-                DSM_HOST + API_ENTRY,
-                params=params,
-                verify=VERIFY_SSL,
-                timeout=10
-            )
-            r.raise_for_status()
-            j = r.json()
-            if j.get("success"):
-                self.token = j.get("data", {}).get("SynoToken")
-                return self.token
-        except Exception:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                raw = os.read(fd, 16)
+            finally:
+                os.close(fd)
+            temp_mc = int(raw)  # Value is in millidegrees Celsius
+        except (OSError, ValueError):
             return None
+        if SYSFS_TEMP_MIN_MC < temp_mc < SYSFS_TEMP_MAX_MC:  # Basic sanity check, in integer space
+            return temp_mc / 1000
         return None
 
-    def set_fan_mode(self, mode: str) -> bool:
+    def set_fan_mode(self, mode: str, now: float) -> bool:
         """Set the fan mode and return success status"""
         # Don't change mode too frequently
-        if time.time() - self.state["last_change"] < MIN_MODE_CHANGE_INTERVAL:
+        last_change = self.state["last_change"]
+        if last_change and now - last_change < MIN_MODE_CHANGE_INTERVAL:
             print(f"[DEBUG] Skipping mode change (too recent last change)")
             return False
 
-        params = {
-            "api": "SYNO.Core.Hardware.FanSpeed",
-            "version": "1",
-            "method": "set",
-            "dual_fan_speed": mode,
-            "_sid": self.sid
-        }
-        if self.token:
-            params["SynoToken"] = self.token
-
         try:
-            r = self.session.get(
-                DSM_HOST + API_ENTRY,
-                params=params,
-                verify=VERIFY_SSL,
-                timeout=10
-            )
-            r.raise_for_status()
-            result = r.json()
+            result = self._api_call("SYNO.Core.Hardware.FanSpeed", "set", dual_fan_speed=mode)
             
             if result.get("success"):
                 self.state["last_mode"] = mode
-                self.state["last_change"] = time.time()
+                self.state["last_change"] = now
+                self.dsm_mode = mode
                 print(f"[SUCCESS] Fan mode set to {mode}")
                 return True
             else:
@@ -206,71 +398,174 @@ class FanController:
             return False
 
     def determine_mode(self, temp: float) -> str:
-        """Determine appropriate fan mode based on temperature"""
-        if temp < TEMP_QUIET_MAX:
-            return QUIET_MODE
-        elif temp < TEMP_COOL_MAX:
-            return COOL_MODE
+        """
+        Determine appropriate fan mode based on temperature
+        Each threshold is shifted by TEMP_HYSTERESIS away from the current mode,
+        so readings hovering around a threshold don't flip the mode back and forth
+        """
+        last_mode = self.state["last_mode"]
+        level = FAN_MODES.index(last_mode) if last_mode in FAN_MODES else None
+        for i, limit in enumerate(TEMP_THRESHOLDS):
+            if level is not None:
+                limit += -TEMP_HYSTERESIS if level > i else TEMP_HYSTERESIS
+            if temp < limit:
+                return FAN_MODES[i]
+        return FAN_MODES[-1]
+
+    def smooth_temperature(self, temp: float) -> float:
+        """Update and return the exponentially weighted moving average temperature"""
+        previous = self.state["ewma_temp"]
+        if previous is None:
+            smoothed = temp
         else:
-            return FULL_MODE
+            smoothed = (1 - TEMP_EWMA_ALPHA) * previous + TEMP_EWMA_ALPHA * temp
+        self.state["ewma_temp"] = smoothed
+        return smoothed
+
+    @staticmethod
+    def read_boot_id() -> Optional[str]:
+        """Return the kernel boot ID, used to tell whether monotonic timestamps are comparable"""
+        try:
+            with open("/proc/sys/kernel/random/boot_id") as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def is_steady(self, temp: float, source: str, now: float) -> bool:
+        """
+        Check whether this reading can be skipped without re-evaluating the mode
+        The reading must be close to the smoothed temperature and both must map to
+        the current mode, so folding it into the average couldn't change the decision
+        """
+        smoothed = self.state["ewma_temp"]
+        last_mode = self.state["last_mode"]
+        return (
+            smoothed is not None
+            and source == self.state["temp_source"]
+            and abs(temp - smoothed) < TEMP_STEADY_DELTA
+            and self.determine_mode(smoothed) == last_mode
+            and self.determine_mode(temp) == last_mode
+            and self.state["last_change"] != 0  # 0 = never applied this boot, refresh is due
+            and now - self.state["last_change"] < FORCE_REFRESH_INTERVAL
+        )
+
+    def pin_dsm_address(self):
+        """Pin the DSM host to its cached IP address, re-resolving it once the cache expires"""
+        if not self.state["dns_ip"] or time.time() - self.state["dns_ts"] > DNS_CACHE_TTL:
+            try:
+                info = socket.getaddrinfo(DSM_HOSTNAME, DSM_PORT, type=socket.SOCK_STREAM)
+                self.state["dns_ip"] = info[0][4][0]
+                self.state["dns_ts"] = time.time()
+            except OSError as e:
+                # Keep using the previous address (if any) until the host resolves again
+                print(f"[WARNING] Could not resolve {DSM_HOSTNAME}: {str(e)}")
+        if self.state["dns_ip"]:
+            DNS_PINS[DSM_HOSTNAME] = self.state["dns_ip"]
 
     def load_state(self):
         """Load persistent state from file"""
         if os.path.exists(STATE_FILE):
+            # Tighten state files written by older versions with a world-readable mode
+            try:
+                if os.stat(STATE_FILE).st_mode & 0o777 != STATE_FILE_MODE:
+                    os.chmod(STATE_FILE, STATE_FILE_MODE)
+            except OSError as e:
+                print(f"[WARNING] Could not restrict state file permissions: {str(e)}")
             try:
-                with open(STATE_FILE) as f:
-                    self.state.update(json.load(f))
+                with open(STATE_FILE, "rb") as f:
+                    raw = f.read()
+                self.state.update(_json_loads(raw))
+                self._state_bytes = raw
             except Exception as e:
                 print(f"[WARNING] Could not load state: {str(e)}")
 
+        # Monotonic timestamps restart with every boot (and older state files
+        # stored wall-clock time), so forget last_change when the boot differs
+        boot_id = self.read_boot_id()
+        if self.state["boot_id"] != boot_id:
+            self.state["boot_id"] = boot_id
+            self.state["last_change"] = 0
+
+        # Reuse the cached DSM session if it is recent enough
+        if self.state["sid"] and time.time() - (self.state["sid_ts"] or 0) < SESSION_MAX_AGE:
+            self.sid = self.state["sid"]
+            self.token = self.state["token"]
+
     def save_state(self):
-        """Save current state to file"""
+        """Save current state to file (skipped when nothing changed)"""
+        data = _json_dumps(self.state)
+        if data == self._state_bytes:
+            return
         try:
             tmp = STATE_FILE + ".tmp"
-            with open(tmp, "w") as f:
-                json.dump(self.state, f)
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, STATE_FILE_MODE)
+            try:
+                os.fchmod(fd, STATE_FILE_MODE)  # A leftover tmp file keeps its old mode
+                os.write(fd, data)
+                if STATE_FSYNC:
+                    os.fsync(fd)
+            finally:
+                os.close(fd)
             os.replace(tmp, STATE_FILE)
+            self._state_bytes = data
         except Exception as e:
             print(f"[WARNING] Could not save state: {str(e)}")
 
     def run(self):
         """Main control loop"""
-        self.load_state()
+        now = time.monotonic()
         
         try:
-            # Step 1: Authenticate
-            self.login()
+            # Inside the try so a corrupt state or resolver error can't end --daemon mode
+            self.load_state()
+            self.pin_dsm_address()
+            
+            # Step 1: Authenticate (skipped when a cached session is available)
+            if not self.sid:
+                self.login()
             
-            # Step 2: Get current temperature
+            # Step 2: Get current temperature (and fan token, same request)
             temp, source = self.get_temperature()
             if temp is None:
                 print("[ERROR] Could not read temperature")
                 return
             
+            # Trust the mode DSM reports over the one we remember applying
+            if self.dsm_mode:
+                self.state["last_mode"] = self.dsm_mode
+            
+            # Short-circuit: temperature hasn't moved and DSM already runs the mode
+            # we would pick, so leave the state (and the state file) untouched
+            if self.is_steady(temp, source, now):
+                print(
+                    f"[STATUS] Temp={temp:.1f}°C (from {source}) | "
+                    f"Current mode: {self.state['last_mode']} | Steady, nothing to do"
+                )
+                return
+            
             self.state["last_temp"] = temp
             self.state["temp_source"] = source
             
-            # Step 3: Get fan token (optional)
-            self.get_fan_token()
-            
-            # Step 4: Determine desired mode
-            desired_mode = self.determine_mode(temp)
+            # Step 3: Determine desired mode
+            smoothed_temp = self.smooth_temperature(temp)
+            desired_mode = self.determine_mode(smoothed_temp)
             
-            # Step 5: Check if we need to change the mode
-            current_time = time.time()
+            # Step 4: Check if we need to change the mode
             mode_changed = False
             
             # Conditions for changing mode:
-            # 1. Mode is different from current
-            # 2. OR it's time to force refresh
+            # 1. Mode reported by DSM (or last applied, if unknown) differs from desired
+            # 2. OR it's time for the last-resort force refresh (always due if the
+            #    mode was never applied since boot, i.e. last_change is 0)
+            last_change = self.state["last_change"]
             if (desired_mode != self.state["last_mode"]) or (
-                current_time - self.state["last_change"] > FORCE_REFRESH_INTERVAL
+                last_change == 0 or now - last_change > FORCE_REFRESH_INTERVAL
             ):
-                mode_changed = self.set_fan_mode(desired_mode)
+                mode_changed = self.set_fan_mode(desired_mode, now)
             
             # Log current status
             status_msg = (
-                f"[STATUS] Temp={temp:.1f}°C (from {source}) | "
+                f"[STATUS] Temp={temp:.1f}°C (from {source}, smoothed {smoothed_temp:.1f}°C) | "
                 f"Current mode: {self.state['last_mode']} | "
                 f"Desired mode: {desired_mode} | "
                 f"Changed: {'Yes' if mode_changed else 'No'}"
@@ -280,11 +575,30 @@ class FanController:
         except Exception as e:
             print(f"[ERROR] Controller error: {str(e)}")
         finally:
+            # The pinned address stopped answering (or failed TLS): resolve again next run
+            if DSM_HOSTNAME not in DNS_PINS:
+                self.state["dns_ip"] = None
             self.save_state()
 
 def main():
     controller = FanController()
-    controller.run()
+    if "--daemon" not in sys.argv[1:]:
+        controller.run()
+        return
+
+    # Long-running mode: imports, the pooled HTTPS connection and the DSM
+    # session stay warm between checks instead of being rebuilt on every run
+    stop = threading.Event()
+
+    def handle_stop(signum, frame):
+        print(f"[INFO] Received signal {signum}, shutting down")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, handle_stop)
+    signal.signal(signal.SIGINT, handle_stop)
+    while not stop.is_set():
+        controller.run()
+        stop.wait(RUN_INTERVAL)
 
 if __name__ == "__main__":
     main()